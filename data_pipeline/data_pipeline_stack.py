@@ -1,19 +1,64 @@
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import jsii
 from aws_cdk import (
+    BundlingOptions,
+    ILocalBundling,
     Stack,
     aws_s3 as s3,
     aws_lambda as _lambda,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_iam as iam,
     aws_glue as glue,
     aws_athena as athena,
     aws_lakeformation as lakeformation,
     aws_events as events,
     aws_events_targets as targets,
+    aws_sqs as sqs,
     Duration,
     RemovalPolicy,
     CfnOutput
 )
 from constructs import Construct
 
+LAMBDA_SOURCE_DIR = "lambda_functions"
+
+# pyarrow and orjson ship native extensions, so install wheels built for the
+# Lambda runtime (PYTHON_3_11 on x86_64) rather than for the synth host; keep
+# in sync with scripts/deploy_lambda.py
+LAMBDA_PLATFORM_ARGS = [
+    "--platform", "manylinux2014_x86_64",
+    "--only-binary=:all:",
+    "--python-version", "3.11",
+    "--implementation", "cp"
+]
+
+
+@jsii.implements(ILocalBundling)
+class LocalPipBundling:
+    """Bundle the Lambda asset with the host's pip so Docker isn't needed"""
+
+    def try_bundle(self, output_dir, options):
+        try:
+            subprocess.run([
+                sys.executable, "-m", "pip", "install",
+                "--no-compile",
+                *LAMBDA_PLATFORM_ARGS,
+                "-r", str(Path(LAMBDA_SOURCE_DIR) / "requirements.txt"),
+                "-t", output_dir
+            ], check=True)
+        except (OSError, subprocess.CalledProcessError):
+            # Fall back to bundling in the Lambda build image
+            return False
+
+        for py_file in Path(LAMBDA_SOURCE_DIR).glob("*.py"):
+            shutil.copy2(py_file, output_dir)
+        return True
+
 
 class DataPipelineStack(Stack):
 
@@ -51,27 +96,48 @@ class DataPipelineStack(Stack):
             ]
         )
 
-        # Create IAM role for Lambda function
+        # Create IAM role for Lambda function with permission to write to S3
         lambda_role = iam.Role(
             self, "DataPipelineLambdaRole",
             assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
             managed_policies=[
                 iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")
-            ]
+            ],
+            inline_policies={
+                "DataPipelineLambdaS3Access": iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=["s3:PutObject", "s3:AbortMultipartUpload"],
+                            resources=[f"{self.data_bucket.bucket_arn}/*"]
+                        )
+                    ]
+                )
+            }
         )
 
-        # Grant Lambda permissions to write to S3
-        self.data_bucket.grant_write(lambda_role)
-
         # Create Lambda function for data extraction
         self.data_extractor_lambda = _lambda.Function(
             self, "DataPipelineDataExtractorLambda",
             function_name="data-pipeline-data-extractor",
             runtime=_lambda.Runtime.PYTHON_3_11,
             handler="data_extractor.lambda_handler",
-            code=_lambda.Code.from_asset("lambda_functions"),
-            timeout=Duration.minutes(5),
-            memory_size=256,
+            # Bundle requirements.txt into the asset so every cdk deploy ships
+            # the handler together with its dependencies
+            code=_lambda.Code.from_asset(
+                LAMBDA_SOURCE_DIR,
+                exclude=["__pycache__", "*.pyc"],
+                bundling=BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_11.bundling_image,
+                    command=[
+                        "bash", "-c",
+                        "pip install --no-compile -r requirements.txt -t /asset-output && cp -au *.py /asset-output"
+                    ],
+                    local=LocalPipBundling()
+                )
+            ),
+            timeout=Duration.seconds(30),
+            # Lambda scales CPU with memory; override per environment after power tuning
+            memory_size=int(os.environ.get("EXTRACTOR_MEMORY_MB", "1024")),
             role=lambda_role,
             environment={
                 "BUCKET_NAME": self.data_bucket.bucket_name
@@ -88,37 +154,56 @@ class DataPipelineStack(Stack):
             }
         )
 
-        # Create IAM role for Glue Crawler
-        glue_crawler_role = iam.Role(
-            self, "DataPipelineGlueCrawlerRole",
-            assumed_by=iam.ServicePrincipal("glue.amazonaws.com"),
-            managed_policies=[
-                iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSGlueServiceRole")
-            ]
-        )
-
-        # Grant Glue Crawler permissions to read from S3
-        self.data_bucket.grant_read(glue_crawler_role)
-
-        # Create Glue Crawler
-        self.glue_crawler = glue.CfnCrawler(
-            self, "DataPipelineGlueCrawler",
-            name="data-pipeline-crawler",
-            role=glue_crawler_role.role_arn,
+        # Create Glue Table with partition projection so Athena prunes
+        # ingest_date partitions without a crawler or GetPartitions calls
+        self.glue_table = glue.CfnTable(
+            self, "DataPipelineGlueTable",
+            catalog_id=self.account,
             database_name=self.glue_database.ref,
-            targets={
-                "s3Targets": [
-                    {
-                        "path": f"s3://{self.data_bucket.bucket_name}/raw-data/"
-                    }
-                ]
-            },
-            schedule={
-                "scheduleExpression": "cron(0 2 * * ? *)"  # Run daily at 2 AM UTC
-            },
-            schema_change_policy={
-                "updateBehavior": "UPDATE_IN_DATABASE",
-                "deleteBehavior": "LOG"
+            table_input={
+                "name": "users",
+                "description": "Users extracted from JSONPlaceholder API",
+                "tableType": "EXTERNAL_TABLE",
+                "partitionKeys": [
+                    {"name": "ingest_date", "type": "string"}
+                ],
+                "parameters": {
+                    "classification": "parquet",
+                    "parquet.compression": "SNAPPY",
+                    "projection.enabled": "true",
+                    "projection.ingest_date.type": "date",
+                    "projection.ingest_date.range": "2024-01-01,NOW",
+                    "projection.ingest_date.format": "yyyy-MM-dd",
+                    "projection.ingest_date.interval": "1",
+                    "projection.ingest_date.interval.unit": "DAYS",
+                    "storage.location.template": f"s3://{self.data_bucket.bucket_name}/raw-data/ingest_date=${{ingest_date}}/"
+                },
+                "storageDescriptor": {
+                    "location": f"s3://{self.data_bucket.bucket_name}/raw-data/",
+                    "inputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    "outputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    "serdeInfo": {
+                        "serializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    },
+                    "columns": [
+                        {"name": "id", "type": "int"},
+                        {"name": "name", "type": "string"},
+                        {"name": "username", "type": "string"},
+                        {"name": "email", "type": "string"},
+                        {"name": "phone", "type": "string"},
+                        {"name": "website", "type": "string"},
+                        {"name": "address_street", "type": "string"},
+                        {"name": "address_suite", "type": "string"},
+                        {"name": "address_city", "type": "string"},
+                        {"name": "address_zipcode", "type": "string"},
+                        {"name": "address_lat", "type": "double"},
+                        {"name": "address_lng", "type": "double"},
+                        {"name": "company_name", "type": "string"},
+                        {"name": "company_catchphrase", "type": "string"},
+                        {"name": "company_bs", "type": "string"},
+                        {"name": "extraction_timestamp", "type": "timestamp"}
+                    ]
+                }
             }
         )
 
@@ -128,26 +213,39 @@ class DataPipelineStack(Stack):
             admins=[
                 lakeformation.CfnDataLakeSettings.DataLakePrincipalProperty(
                     data_lake_principal_identifier=lambda_role.role_arn
-                ),
-                lakeformation.CfnDataLakeSettings.DataLakePrincipalProperty(
-                    data_lake_principal_identifier=glue_crawler_role.role_arn
                 )
             ]
         )
 
-        # Create IAM role for Athena users
+        # Create IAM role for Athena users with permission to read from the data
+        # bucket and write to the results bucket
         self.athena_role = iam.Role(
             self, "DataPipelineAthenaRole",
             assumed_by=iam.ServicePrincipal("athena.amazonaws.com"),
             managed_policies=[
                 iam.ManagedPolicy.from_aws_managed_policy_name("AmazonAthenaFullAccess")
-            ]
+            ],
+            inline_policies={
+                "DataPipelineAthenaS3Access": iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=["s3:GetObject*", "s3:GetBucket*", "s3:List*"],
+                            resources=[
+                                self.data_bucket.bucket_arn,
+                                f"{self.data_bucket.bucket_arn}/*",
+                                self.athena_results_bucket.bucket_arn,
+                                f"{self.athena_results_bucket.bucket_arn}/*"
+                            ]
+                        ),
+                        iam.PolicyStatement(
+                            actions=["s3:PutObject", "s3:DeleteObject*", "s3:AbortMultipartUpload"],
+                            resources=[f"{self.athena_results_bucket.bucket_arn}/*"]
+                        )
+                    ]
+                )
+            }
         )
 
-        # Grant Athena permissions to read from data bucket and write to results bucket
-        self.data_bucket.grant_read(self.athena_role)
-        self.athena_results_bucket.grant_read_write(self.athena_role)
-
         # Create Athena Workgroup
         self.athena_workgroup = athena.CfnWorkGroup(
             self, "DataPipelineAthenaWorkGroup",
@@ -155,10 +253,17 @@ class DataPipelineStack(Stack):
             description="Workgroup for data pipeline queries",
             work_group_configuration={
                 "resultConfiguration": {
-                    "outputLocation": f"s3://{self.athena_results_bucket.bucket_name}/query-results/"
+                    "outputLocation": f"s3://{self.athena_results_bucket.bucket_name}/query-results/",
+                    "expectedBucketOwner": self.account
+                },
+                # Engine version 3 is required for query result reuse
+                "engineVersion": {
+                    "selectedEngineVersion": "Athena engine version 3"
                 },
                 "enforceWorkGroupConfiguration": True,
-                "publishCloudWatchMetrics": True
+                "publishCloudWatchMetrics": True,
+                "requesterPaysEnabled": False,
+                "bytesScannedCutoffPerQuery": 1024 * 1024 * 1024  # Cancel queries scanning more than 1 GB
             }
         )
 
@@ -175,21 +280,40 @@ class DataPipelineStack(Stack):
             description="Trigger data extraction lambda daily at 1 AM UTC"
         )
 
-        # Add Lambda as target to the EventBridge rule
+        # Queue extraction requests so one warm Lambda processes them in batches
+        extraction_dlq = sqs.Queue(
+            self, "DataPipelineExtractionDLQ",
+            retention_period=Duration.days(14)
+        )
+
+        self.extraction_queue = sqs.Queue(
+            self, "DataPipelineExtractionQueue",
+            visibility_timeout=Duration.minutes(4),  # 6x the Lambda timeout plus the batching window
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=extraction_dlq
+            )
+        )
+
+        # Add the queue as target to the EventBridge rule
         lambda_schedule_rule.add_target(
-            targets.LambdaFunction(
-                self.data_extractor_lambda,
-                event=events.RuleTargetInput.from_object({
+            targets.SqsQueue(
+                self.extraction_queue,
+                message=events.RuleTargetInput.from_object({
                     "bucket_name": self.data_bucket.bucket_name
                 })
             )
         )
 
-        # Grant EventBridge permission to invoke Lambda
-        self.data_extractor_lambda.add_permission(
-            "AllowEventBridge",
-            principal=iam.ServicePrincipal("events.amazonaws.com"),
-            source_arn=lambda_schedule_rule.rule_arn
+        # Consume extraction requests from the queue in batches
+        self.data_extractor_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                self.extraction_queue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(30),
+                # Only messages the handler rejects are retried and dead-lettered
+                report_batch_item_failures=True
+            )
         )
 
         # Stack Outputs
@@ -212,9 +336,9 @@ class DataPipelineStack(Stack):
         )
 
         CfnOutput(
-            self, "GlueCrawlerName",
-            value=self.glue_crawler.ref,
-            description="Name of the Glue crawler"
+            self, "GlueTableName",
+            value=self.glue_table.ref,
+            description="Name of the Glue table"
         )
 
         CfnOutput(
@@ -223,6 +347,12 @@ class DataPipelineStack(Stack):
             description="Name of the Athena workgroup"
         )
 
+        CfnOutput(
+            self, "ExtractionQueueUrl",
+            value=self.extraction_queue.queue_url,
+            description="URL of the SQS queue feeding the data extractor Lambda function"
+        )
+
         CfnOutput(
             self, "LambdaFunctionName",
             value=self.data_extractor_lambda.function_name,
@@ -1,101 +1,226 @@
 import json
 import boto3
+import orjson
 import requests
-from datetime import datetime
-import csv
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timezone
 import io
 import logging
 import os
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Clients are created once per container so warm invocations reuse their connections
+S3 = boto3.client('s3', config=Config(tcp_keepalive=True, retries={'max_attempts': 5, 'mode': 'adaptive'}))
+
+# (connect, read) timeout per attempt. With 2 retries the worst case is
+# 3 attempts x 8 s plus about 1 s of backoff, inside the 30 s function timeout,
+# so a slow API surfaces as a handled RequestException rather than a timeout.
+# Retry-After is ignored for the same reason.
+HTTP_TIMEOUT = (3, 5)
+
+HTTP = requests.Session()
+HTTP.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=False
+    )
+))
+
+# Explicit Parquet schema for the flattened users table
+USERS_SCHEMA = pa.schema([
+    ('id', pa.int32()),
+    ('name', pa.string()),
+    ('username', pa.string()),
+    ('email', pa.string()),
+    ('phone', pa.string()),
+    ('website', pa.string()),
+    ('address_street', pa.string()),
+    ('address_suite', pa.string()),
+    ('address_city', pa.string()),
+    ('address_zipcode', pa.string()),
+    ('address_lat', pa.float64()),
+    ('address_lng', pa.float64()),
+    ('company_name', pa.string()),
+    ('company_catchphrase', pa.string()),
+    ('company_bs', pa.string()),
+    ('extraction_timestamp', pa.timestamp('us', tz='UTC'))
+])
+
+# Source path in the API payload for each flattened column
+FIELD_PATHS = (
+    ('id', ('id',)),
+    ('name', ('name',)),
+    ('username', ('username',)),
+    ('email', ('email',)),
+    ('phone', ('phone',)),
+    ('website', ('website',)),
+    ('address_street', ('address', 'street')),
+    ('address_suite', ('address', 'suite')),
+    ('address_city', ('address', 'city')),
+    ('address_zipcode', ('address', 'zipcode')),
+    ('address_lat', ('address', 'geo', 'lat')),
+    ('address_lng', ('address', 'geo', 'lng')),
+    ('company_name', ('company', 'name')),
+    ('company_catchphrase', ('company', 'catchPhrase')),
+    ('company_bs', ('company', 'bs'))
+)
+
+# Columns delivered as strings by the API but stored as floats
+FLOAT_COLUMNS = ('address_lat', 'address_lng')
+
+def _dig(data, path):
+    """Walk a nested dict along path, returning None if any level is missing"""
+    for key in path:
+        data = data.get(key) if isinstance(data, dict) else None
+    return data
+
+def _to_float(value):
+    """Convert API coordinate strings to floats, keeping missing values as None"""
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _extraction_requests(event):
+    """Return (message_id, request) pairs for an SQS batch, or one pair for a direct invoke.
+    
+    Malformed SQS bodies are returned with a None request so they can be
+    reported as failures on their own.
+    """
+    if 'Records' not in event:
+        return [(None, event)]
+    
+    extraction_requests = []
+    for record in event['Records']:
+        try:
+            request = json.loads(record['body'])
+        except ValueError:
+            request = None
+        extraction_requests.append((record['messageId'], request if isinstance(request, dict) else None))
+    return extraction_requests
+
+def _resolve_bucket(extraction_requests):
+    """Pick the batch's target bucket and the messages that can't be written to it.
+    
+    Requests without a bucket (and no BUCKET_NAME fallback) or naming a
+    different bucket than the first valid one are returned as failed message
+    ids, so SQS retries or dead-letters just those messages.
+    """
+    bucket_name = None
+    failed_message_ids = []
+    for message_id, request in extraction_requests:
+        requested_bucket = (request or {}).get('bucket_name') or os.environ.get('BUCKET_NAME')
+        if request is None or not requested_bucket:
+            logger.warning(f"Dropping malformed extraction request {message_id}")
+            failed_message_ids.append(message_id)
+        elif bucket_name and requested_bucket != bucket_name:
+            logger.warning(f"Extraction request {message_id} names bucket {requested_bucket}, not {bucket_name}")
+            failed_message_ids.append(message_id)
+        else:
+            bucket_name = requested_bucket
+    return bucket_name, failed_message_ids
+
 def lambda_handler(event, context):
     """
     Lambda function to extract data from JSONPlaceholder API and store in S3
     """
     try:
-        # Get bucket name from event, environment variable, or raise error
-        bucket_name = event.get('bucket_name') or os.environ.get('BUCKET_NAME')
+        # One timestamp per run so every row and the S3 key agree
+        timestamp = datetime.now(timezone.utc)
+        
+        extraction_requests = _extraction_requests(event)
+        
+        # Get bucket name from each request or the environment variable
+        bucket_name, failed_message_ids = _resolve_bucket(extraction_requests)
+        batch_item_failures = [{'itemIdentifier': message_id} for message_id in failed_message_ids]
         if not bucket_name:
+            if 'Records' in event:
+                # Nothing valid in the batch; report every message as failed
+                return {'batchItemFailures': batch_item_failures}
             raise ValueError("Bucket name not provided in event or environment variables")
         
         logger.info(f"Using bucket: {bucket_name}")
+        logger.info(f"Processing {len(extraction_requests) - len(failed_message_ids)} extraction request(s)")
         
-        # Initialize S3 client
-        s3_client = boto3.client('s3')
-        
-        # Call JSONPlaceholder API
+        # Every request asks for the same /users snapshot, so a batch is served
+        # by a single API call rather than one duplicate copy per message
         logger.info("Calling JSONPlaceholder API...")
-        response = requests.get('https://jsonplaceholder.typicode.com/users', timeout=30)
+        response = HTTP.get('https://jsonplaceholder.typicode.com/users', timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         
-        users_data = response.json()
+        users_data = orjson.loads(response.content)
         logger.info(f"Retrieved {len(users_data)} users from API")
         
-        # Process and flatten the data for better structure
-        processed_data = []
-        for user in users_data:
-            flat_user = {
-                'id': user.get('id'),
-                'name': user.get('name'),
-                'username': user.get('username'),
-                'email': user.get('email'),
-                'phone': user.get('phone'),
-                'website': user.get('website'),
-                'address_street': user.get('address', {}).get('street'),
-                'address_suite': user.get('address', {}).get('suite'),
-                'address_city': user.get('address', {}).get('city'),
-                'address_zipcode': user.get('address', {}).get('zipcode'),
-                'address_lat': user.get('address', {}).get('geo', {}).get('lat'),
-                'address_lng': user.get('address', {}).get('geo', {}).get('lng'),
-                'company_name': user.get('company', {}).get('name'),
-                'company_catchphrase': user.get('company', {}).get('catchPhrase'),
-                'company_bs': user.get('company', {}).get('bs'),
-                'extraction_timestamp': datetime.utcnow().isoformat()
-            }
-            processed_data.append(flat_user)
+        # Flatten the nested user records straight into columns
+        columns = {
+            name: [_dig(user, path) for user in users_data]
+            for name, path in FIELD_PATHS
+        }
+        columns['extraction_timestamp'] = [timestamp] * len(users_data)
+        for name in FLOAT_COLUMNS:
+            columns[name] = [_to_float(value) for value in columns[name]]
         
-        # Convert to CSV format
-        csv_buffer = io.StringIO()
-        if processed_data:
-            fieldnames = processed_data[0].keys()
-            writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(processed_data)
+        # Write the whole batch as one Snappy-compressed Parquet file so Athena can prune columns
+        table = pa.table(columns, schema=USERS_SCHEMA)
+        parquet_buffer = io.BytesIO()
+        pq.write_table(
+            table,
+            parquet_buffer,
+            compression='snappy',
+            use_dictionary=True,
+            data_page_size=1 << 20
+        )
+        parquet_buffer.seek(0)
         
-        # Generate S3 key with timestamp for partitioning
-        timestamp = datetime.utcnow()
-        s3_key = f"raw-data/year={timestamp.year}/month={timestamp.month:02d}/day={timestamp.day:02d}/users_{timestamp.strftime('%Y%m%d_%H%M%S')}.csv"
+        # Generate S3 key with an ingest_date partition matching the table's projection
+        s3_key = f"raw-data/ingest_date={timestamp:%Y-%m-%d}/users_{timestamp:%Y%m%d_%H%M%S}.parquet"
         
         # Upload to S3
         logger.info(f"Uploading data to S3: {bucket_name}/{s3_key}")
-        s3_client.put_object(
+        S3.put_object(
             Bucket=bucket_name,
             Key=s3_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
+            Body=parquet_buffer,  # Streamed from the buffer without copying it
+            ContentType='application/x-parquet'
         )
         
-        return {
+        result = {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Data extraction and upload successful',
-                'records_processed': len(processed_data),
+                'records_processed': table.num_rows,
                 's3_location': f's3://{bucket_name}/{s3_key}',
-                'timestamp': timestamp.isoformat()
+                'timestamp': timestamp.isoformat(timespec='seconds')
             })
         }
+        if 'Records' in event:
+            # Partial batch response: only the rejected messages are retried
+            result['batchItemFailures'] = batch_item_failures
+        return result
         
     except requests.exceptions.RequestException as e:
         logger.error(f"API request failed: {str(e)}")
+        if 'Records' in event:
+            raise  # Let SQS retry the batch
         return {
             'statusCode': 500,
             'body': json.dumps({'error': f'API request failed: {str(e)}'})
         }
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
+        if 'Records' in event:
+            raise  # Let SQS retry the batch
         return {
             'statusCode': 500,
             'body': json.dumps({'error': f'Unexpected error: {str(e)}'})
@@ -4,12 +4,19 @@ AWS CDK Data Pipeline Cleanup Script
 
 This script removes all AWS resources created by the data pipeline.
 It handles the proper cleanup sequence and provides detailed feedback.
+
+By default the stack is deleted directly through CloudFormation. Pass
+--reuse-synth to run `npx cdk --app cdk.out destroy --force` against the
+existing cdk.out instead of re-synthesizing the app. The same applies to
+iterative deploys: `npx cdk --app cdk.out deploy` skips the synth step.
 """
 
+import argparse
 import boto3
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 
@@ -22,13 +29,16 @@ class DataPipelineCleanup:
             self.lambda_client = boto3.client('lambda')
             self.glue_client = boto3.client('glue')
             self.cf_client = boto3.client('cloudformation')
+            self.stack_delete_waiter = self.cf_client.get_waiter('stack_delete_complete')
+            
+            # Set once stack deletion has been confirmed, so verification can skip it
+            self.stack_deleted = False
             
             # Resource names from the CDK stack
             self.config = {
                 'stack_name': 'DataPipelineStack',
                 'workgroup_name': 'data-pipeline-workgroup',
                 'database_name': 'data_pipeline_db',
-                'crawler_name': 'data-pipeline-crawler',
                 'lambda_function_name': 'data-pipeline-data-extractor'
             }
             
@@ -80,27 +90,51 @@ class DataPipelineCleanup:
         """Delete Athena WorkGroup with all query executions"""
         print("\n🗂️  Step 1: Cleaning Athena WorkGroup")
         
-        try:
-            # Check if workgroup exists
-            response = self.athena_client.list_work_groups()
-            workgroups = [wg['Name'] for wg in response.get('WorkGroups', [])]
-            
-            if self.config['workgroup_name'] not in workgroups:
-                print("   ✅ Athena WorkGroup not found (already deleted)")
-                return True
-                
-            # Delete workgroup with recursive option
-            self.athena_client.delete_work_group(
+        # Delete workgroup with recursive option; Athena reports a missing
+        # workgroup as InvalidRequestException, but uses the same exception for
+        # other rejected deletes, so only its "is not found" message counts
+        return self.safe_delete(
+            lambda: self.athena_client.delete_work_group(
                 WorkGroup=self.config['workgroup_name'],
                 RecursiveDeleteOption=True
-            )
-            print(f"   ✅ Deleted WorkGroup: {self.config['workgroup_name']}")
+            ),
+            (self.athena_client.exceptions.InvalidRequestException,),
+            f"Athena WorkGroup {self.config['workgroup_name']}",
+            is_not_found=lambda e: 'not found' in e.response['Error'].get('Message', '').lower()
+        )
+
+    def safe_delete(self, delete, not_found_errors, label, is_not_found=None):
+        """Call delete directly, treating a not-found error as already deleted.
+        
+        is_not_found optionally narrows not_found_errors for services that
+        reuse the same exception for other failures.
+        """
+        try:
+            delete()
+            print(f"   ✅ Deleted {label}")
+            return True
+        except not_found_errors as e:
+            if is_not_found and not is_not_found(e):
+                print(f"   ⚠️  Error deleting {label}: {str(e)}")
+                return False
+            print(f"   ✅ {label} not found (already deleted)")
             return True
-            
         except Exception as e:
-            print(f"   ❌ Error deleting Athena WorkGroup: {str(e)}")
+            print(f"   ⚠️  Error deleting {label}: {str(e)}")
             return False
 
+    def workgroup_exists(self):
+        """Page through Athena workgroups, stopping as soon as ours is found"""
+        # list_work_groups has no boto3 paginator, so follow NextToken manually
+        kwargs = {}
+        while True:
+            page = self.athena_client.list_work_groups(**kwargs)
+            if any(wg['Name'] == self.config['workgroup_name'] for wg in page['WorkGroups']):
+                return True
+            if 'NextToken' not in page:
+                return False
+            kwargs['NextToken'] = page['NextToken']
+
     def empty_s3_buckets(self):
         """Empty S3 buckets before deletion"""
         print("\n🪣 Step 2: Emptying S3 buckets")
@@ -122,134 +156,138 @@ class DataPipelineCleanup:
         # Remove duplicates
         buckets_to_empty = list(set(buckets_to_empty))
         
-        for bucket_name in buckets_to_empty:
-            try:
-                # Check if bucket exists
-                self.s3_client.head_bucket(Bucket=bucket_name)
-                
-                # List and delete all objects
-                paginator = self.s3_client.get_paginator('list_objects_v2')
-                pages = paginator.paginate(Bucket=bucket_name)
-                
-                delete_count = 0
-                for page in pages:
-                    if 'Contents' in page:
-                        objects = [{'Key': obj['Key']} for obj in page['Contents']]
-                        if objects:
-                            self.s3_client.delete_objects(
-                                Bucket=bucket_name,
-                                Delete={'Objects': objects}
-                            )
-                            delete_count += len(objects)
-                
-                print(f"   ✅ Emptied bucket: {bucket_name} ({delete_count} objects)")
-                
-            except self.s3_client.exceptions.NoSuchBucket:
-                print(f"   ✅ Bucket not found: {bucket_name} (already deleted)")
-            except Exception as e:
-                print(f"   ⚠️  Error with bucket {bucket_name}: {str(e)}")
+        # Empty the buckets concurrently
+        with ThreadPoolExecutor(max_workers=len(buckets_to_empty)) as executor:
+            list(executor.map(self.empty_s3_bucket, buckets_to_empty))
         
         return True
 
+    def empty_s3_bucket(self, bucket_name):
+        """Delete all objects in a bucket, sending delete batches in parallel"""
+        try:
+            # List every object version and delete marker (the data bucket is versioned)
+            paginator = self.s3_client.get_paginator('list_object_versions')
+            pages = paginator.paginate(Bucket=bucket_name)
+            
+            # Split into batches of up to 1000 (the DeleteObjects limit)
+            batches = []
+            for page in pages:
+                objects = [
+                    {'Key': obj['Key'], 'VersionId': obj['VersionId']}
+                    for obj in page.get('Versions', []) + page.get('DeleteMarkers', [])
+                ]
+                for start in range(0, len(objects), 1000):
+                    batches.append(objects[start:start + 1000])
+            
+            # DeleteObjects is I/O-bound, so issue the batches concurrently
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                delete_count = sum(executor.map(
+                    lambda objects: self.delete_object_batch(bucket_name, objects),
+                    batches
+                ))
+            
+            total_count = sum(len(objects) for objects in batches)
+            if delete_count < total_count:
+                print(f"   ⚠️  Could not empty bucket {bucket_name}: "
+                      f"{total_count - delete_count} of {total_count} object versions not deleted")
+            else:
+                print(f"   ✅ Emptied bucket: {bucket_name} ({delete_count} object versions)")
+            
+        except self.s3_client.exceptions.NoSuchBucket:
+            print(f"   ✅ Bucket not found: {bucket_name} (already deleted)")
+        except Exception as e:
+            print(f"   ⚠️  Error with bucket {bucket_name}: {str(e)}")
+
+    def delete_object_batch(self, bucket_name, objects):
+        """Delete one batch of objects and return how many were actually deleted"""
+        response = self.s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': objects, 'Quiet': True}
+        )
+        # In quiet mode only the failed keys are returned
+        errors = response.get('Errors', [])
+        for error in errors:
+            print(f"   ⚠️  Could not delete {bucket_name}/{error['Key']}: {error.get('Code')} - {error.get('Message')}")
+        return len(objects) - len(errors)
+
     def run_cdk_destroy(self):
-        """Run CDK destroy command"""
-        print("\n🔥 Step 3: Running CDK destroy")
+        """Run CDK destroy against the previously synthesized cdk.out"""
+        print("\n🔥 Step 3: Running CDK destroy from cdk.out")
+        
+        project_dir = Path(__file__).parent.parent
+        if not (project_dir / 'cdk.out').exists():
+            print("   ⚠️  cdk.out not found, run 'npx cdk synth' first")
+            return False
         
         try:
-            # Change to project directory
-            project_dir = Path(__file__).parent.parent
-            
-            # Run CDK destroy
+            # --app cdk.out skips the synth step entirely
             result = subprocess.run(
-                ['npx', 'cdk', 'destroy', '--force'],
+                ['npx', 'cdk', '--app', 'cdk.out', 'destroy', '--force'],
                 cwd=project_dir,
                 capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout
+                text=True
             )
             
             if result.returncode == 0:
                 print("   ✅ CDK destroy completed successfully")
+                self.stack_deleted = True
                 return True
             else:
-                print(f"   ❌ CDK destroy failed:")
+                print("   ❌ CDK destroy failed:")
                 print(f"   Error: {result.stderr}")
                 return False
                 
-        except subprocess.TimeoutExpired:
-            print("   ❌ CDK destroy timed out")
-            return False
         except Exception as e:
             print(f"   ❌ Error running CDK destroy: {str(e)}")
             return False
 
     def manual_resource_cleanup(self):
-        """Manual cleanup of individual resources if CDK destroy fails"""
+        """Manual cleanup of individual resources if stack deletion fails"""
         print("\n🧹 Step 4: Manual resource cleanup")
         
         # Delete Lambda function
-        try:
-            self.lambda_client.delete_function(
+        self.safe_delete(
+            lambda: self.lambda_client.delete_function(
                 FunctionName=self.config['lambda_function_name']
-            )
-            print(f"   ✅ Deleted Lambda function: {self.config['lambda_function_name']}")
-        except self.lambda_client.exceptions.ResourceNotFoundException:
-            print(f"   ✅ Lambda function not found (already deleted)")
-        except Exception as e:
-            print(f"   ⚠️  Error deleting Lambda function: {str(e)}")
+            ),
+            (self.lambda_client.exceptions.ResourceNotFoundException,),
+            f"Lambda function {self.config['lambda_function_name']}"
+        )
         
-        # Delete Glue resources
-        try:
-            self.glue_client.delete_crawler(Name=self.config['crawler_name'])
-            print(f"   ✅ Deleted Glue crawler: {self.config['crawler_name']}")
-        except self.glue_client.exceptions.EntityNotFoundException:
-            print(f"   ✅ Glue crawler not found (already deleted)")
-        except Exception as e:
-            print(f"   ⚠️  Error deleting Glue crawler: {str(e)}")
-        
-        try:
-            self.glue_client.delete_database(Name=self.config['database_name'])
-            print(f"   ✅ Deleted Glue database: {self.config['database_name']}")
-        except self.glue_client.exceptions.EntityNotFoundException:
-            print(f"   ✅ Glue database not found (already deleted)")
-        except Exception as e:
-            print(f"   ⚠️  Error deleting Glue database: {str(e)}")
+        # Delete Glue database (removes the users table with it)
+        self.safe_delete(
+            lambda: self.glue_client.delete_database(Name=self.config['database_name']),
+            (self.glue_client.exceptions.EntityNotFoundException,),
+            f"Glue database {self.config['database_name']}"
+        )
         
         # Delete S3 buckets
         for bucket_key in ['data_bucket', 'results_bucket']:
             if bucket_key in self.config:
                 bucket_name = self.config[bucket_key]
-                try:
-                    self.s3_client.delete_bucket(Bucket=bucket_name)
-                    print(f"   ✅ Deleted S3 bucket: {bucket_name}")
-                except self.s3_client.exceptions.NoSuchBucket:
-                    print(f"   ✅ S3 bucket not found: {bucket_name} (already deleted)")
-                except Exception as e:
-                    print(f"   ⚠️  Error deleting S3 bucket {bucket_name}: {str(e)}")
+                self.safe_delete(
+                    lambda: self.s3_client.delete_bucket(Bucket=bucket_name),
+                    (self.s3_client.exceptions.NoSuchBucket,),
+                    f"S3 bucket {bucket_name}"
+                )
 
     def delete_cloudformation_stack(self):
-        """Force delete CloudFormation stack if it still exists"""
-        print("\n📋 Step 5: Deleting CloudFormation stack")
+        """Delete the CloudFormation stack directly, without a CDK synth"""
+        print("\n📋 Step 3: Deleting CloudFormation stack")
         
         try:
-            # Check if stack exists
-            response = self.cf_client.describe_stacks(StackName=self.config['stack_name'])
-            if not response['Stacks']:
-                print("   ✅ CloudFormation stack not found (already deleted)")
-                return True
-            
-            # Delete stack
+            # Delete stack (a no-op if it no longer exists)
             self.cf_client.delete_stack(StackName=self.config['stack_name'])
             print(f"   ✅ Initiated deletion of stack: {self.config['stack_name']}")
             
             # Wait for deletion to complete
             print("   ⏳ Waiting for stack deletion to complete...")
-            waiter = self.cf_client.get_waiter('stack_delete_complete')
-            waiter.wait(
+            self.stack_delete_waiter.wait(
                 StackName=self.config['stack_name'],
-                WaiterConfig={'Delay': 15, 'MaxAttempts': 40}  # 10 minutes max
+                WaiterConfig={'Delay': 5, 'MaxAttempts': 120}  # 10 minutes max
             )
             print("   ✅ CloudFormation stack deleted successfully")
+            self.stack_deleted = True
             return True
             
         except self.cf_client.exceptions.ClientError as e:
@@ -265,29 +303,46 @@ class DataPipelineCleanup:
 
     def verify_cleanup(self):
         """Verify that all resources have been deleted"""
-        print("\n✅ Step 6: Verifying cleanup")
+        print("\n✅ Step 5: Verifying cleanup")
         
+        checks = [
+            self.verify_stack_deleted,
+            self.verify_buckets_deleted,
+            self.verify_functions_deleted,
+            self.verify_database_deleted,
+            self.verify_workgroup_deleted
+        ]
+        
+        # Each check is an independent API round-trip, so run them concurrently
         verification_results = []
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [executor.submit(check) for check in checks]
+            for future in as_completed(futures):
+                success, message = future.result()
+                print(f"   {message}")
+                verification_results.append(success)
+        
+        return all(verification_results)
+
+    def verify_stack_deleted(self):
+        """Check that the CloudFormation stack is gone"""
+        if self.stack_deleted:
+            # Already confirmed by the deletion step, no need to describe it again
+            return True, "✅ CloudFormation: Stack deleted successfully"
         
-        # Check CloudFormation stack
         try:
             response = self.cf_client.describe_stacks(StackName=self.config['stack_name'])
             if response['Stacks']:
                 stack_status = response['Stacks'][0]['StackStatus']
                 if 'DELETE_COMPLETE' in stack_status:
-                    print("   ✅ CloudFormation: Stack deleted successfully")
-                    verification_results.append(True)
-                else:
-                    print(f"   ⚠️  CloudFormation: Stack status is {stack_status}")
-                    verification_results.append(False)
-            else:
-                print("   ✅ CloudFormation: Stack not found")
-                verification_results.append(True)
+                    return True, "✅ CloudFormation: Stack deleted successfully"
+                return False, f"⚠️  CloudFormation: Stack status is {stack_status}"
+            return True, "✅ CloudFormation: Stack not found"
         except Exception:
-            print("   ✅ CloudFormation: Stack not found")
-            verification_results.append(True)
-        
-        # Check S3 buckets
+            return True, "✅ CloudFormation: Stack not found"
+
+    def verify_buckets_deleted(self):
+        """Check that no data-pipeline S3 buckets remain"""
         try:
             response = self.s3_client.list_buckets()
             data_pipeline_buckets = [
@@ -295,69 +350,59 @@ class DataPipelineCleanup:
                 if 'data-pipeline' in bucket['Name']
             ]
             if not data_pipeline_buckets:
-                print("   ✅ S3: No data-pipeline buckets found")
-                verification_results.append(True)
-            else:
-                print(f"   ⚠️  S3: Found buckets: {data_pipeline_buckets}")
-                verification_results.append(False)
+                return True, "✅ S3: No data-pipeline buckets found"
+            return False, f"⚠️  S3: Found buckets: {data_pipeline_buckets}"
         except Exception as e:
-            print(f"   ❌ S3: Error checking buckets: {str(e)}")
-            verification_results.append(False)
-        
-        # Check Lambda functions
+            return False, f"❌ S3: Error checking buckets: {str(e)}"
+
+    def verify_functions_deleted(self):
+        """Check that no data-pipeline Lambda functions remain"""
         try:
-            response = self.lambda_client.list_functions()
-            data_pipeline_functions = [
-                func['FunctionName'] for func in response['Functions']
-                if 'data-pipeline' in func['FunctionName']
-            ]
+            # Page through all functions, stopping at the first page with a match
+            data_pipeline_functions = []
+            paginator = self.lambda_client.get_paginator('list_functions')
+            for page in paginator.paginate():
+                data_pipeline_functions = [
+                    func['FunctionName'] for func in page['Functions']
+                    if 'data-pipeline' in func['FunctionName']
+                ]
+                if data_pipeline_functions:
+                    break
             if not data_pipeline_functions:
-                print("   ✅ Lambda: No data-pipeline functions found")
-                verification_results.append(True)
-            else:
-                print(f"   ⚠️  Lambda: Found functions: {data_pipeline_functions}")
-                verification_results.append(False)
+                return True, "✅ Lambda: No data-pipeline functions found"
+            return False, f"⚠️  Lambda: Found functions: {data_pipeline_functions}"
         except Exception as e:
-            print(f"   ❌ Lambda: Error checking functions: {str(e)}")
-            verification_results.append(False)
-        
-        # Check Glue database
+            return False, f"❌ Lambda: Error checking functions: {str(e)}"
+
+    def verify_database_deleted(self):
+        """Check that the Glue database is gone"""
         try:
-            response = self.glue_client.get_databases()
-            data_pipeline_dbs = [
-                db['Name'] for db in response['DatabaseList']
-                if db['Name'] == self.config['database_name']
-            ]
+            # Page through all databases, stopping once ours is found
+            data_pipeline_dbs = []
+            paginator = self.glue_client.get_paginator('get_databases')
+            for page in paginator.paginate():
+                data_pipeline_dbs = [
+                    db['Name'] for db in page['DatabaseList']
+                    if db['Name'] == self.config['database_name']
+                ]
+                if data_pipeline_dbs:
+                    break
             if not data_pipeline_dbs:
-                print("   ✅ Glue: Database not found")
-                verification_results.append(True)
-            else:
-                print(f"   ⚠️  Glue: Found database: {data_pipeline_dbs}")
-                verification_results.append(False)
+                return True, "✅ Glue: Database not found"
+            return False, f"⚠️  Glue: Found database: {data_pipeline_dbs}"
         except Exception as e:
-            print(f"   ❌ Glue: Error checking database: {str(e)}")
-            verification_results.append(False)
-        
-        # Check Athena workgroup
+            return False, f"❌ Glue: Error checking database: {str(e)}"
+
+    def verify_workgroup_deleted(self):
+        """Check that the Athena workgroup is gone"""
         try:
-            response = self.athena_client.list_work_groups()
-            data_pipeline_wgs = [
-                wg['Name'] for wg in response['WorkGroups']
-                if wg['Name'] == self.config['workgroup_name']
-            ]
-            if not data_pipeline_wgs:
-                print("   ✅ Athena: WorkGroup not found")
-                verification_results.append(True)
-            else:
-                print(f"   ⚠️  Athena: Found workgroup: {data_pipeline_wgs}")
-                verification_results.append(False)
+            if not self.workgroup_exists():
+                return True, "✅ Athena: WorkGroup not found"
+            return False, f"⚠️  Athena: Found workgroup: {self.config['workgroup_name']}"
         except Exception as e:
-            print(f"   ❌ Athena: Error checking workgroup: {str(e)}")
-            verification_results.append(False)
-        
-        return all(verification_results)
+            return False, f"❌ Athena: Error checking workgroup: {str(e)}"
 
-    def run_cleanup(self):
+    def run_cleanup(self, reuse_synth=False):
         """Run the complete cleanup process"""
         print("🧹 AWS CDK Data Pipeline Cleanup")
         print("=" * 50)
@@ -371,22 +416,25 @@ class DataPipelineCleanup:
         # Step 2: Empty S3 buckets
         s3_success = self.empty_s3_buckets()
         
-        # Step 3: Run CDK destroy
+        # Step 3: Delete CloudFormation stack
         if stack_exists:
-            cdk_success = self.run_cdk_destroy()
+            if reuse_synth:
+                stack_deleted = self.run_cdk_destroy() or self.delete_cloudformation_stack()
+            else:
+                stack_deleted = self.delete_cloudformation_stack()
             
-            # Step 4: Manual cleanup if CDK destroy failed
-            if not cdk_success:
-                print("\n⚠️  CDK destroy failed, attempting manual cleanup...")
+            # Step 4: Manual cleanup if stack deletion failed
+            if not stack_deleted:
+                print("\n⚠️  Stack deletion failed, attempting manual cleanup...")
                 self.manual_resource_cleanup()
                 
-                # Step 5: Force delete CloudFormation stack
+                # Retry now that the blocking resources are gone
                 self.delete_cloudformation_stack()
         else:
             print("\n⚠️  Stack not found, running manual cleanup...")
             self.manual_resource_cleanup()
         
-        # Step 6: Verify cleanup
+        # Step 5: Verify cleanup
         cleanup_successful = self.verify_cleanup()
         
         # Final summary
@@ -408,9 +456,17 @@ class DataPipelineCleanup:
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Remove all AWS resources created by the data pipeline")
+    parser.add_argument(
+        '--reuse-synth',
+        action='store_true',
+        help="destroy with 'npx cdk --app cdk.out destroy' instead of deleting the stack directly"
+    )
+    args = parser.parse_args()
+    
     try:
         cleanup = DataPipelineCleanup()
-        exit_code = cleanup.run_cleanup()
+        exit_code = cleanup.run_cleanup(reuse_synth=args.reuse_synth)
         sys.exit(exit_code)
     except KeyboardInterrupt:
         print("\n❌ Cleanup cancelled by user")
@@ -57,63 +57,16 @@ npx cdk bootstrap aws://$ACCOUNT/$REGION
 echo "🔍 Synthesizing CloudFormation template..."
 npx cdk synth
 
-# Package Lambda function with dependencies
-echo "📦 Packaging Lambda function..."
-LAMBDA_DIR="lambda_functions"
-PACKAGE_DIR="lambda_package"
-
-# Clean up previous package
-rm -rf $PACKAGE_DIR
-mkdir -p $PACKAGE_DIR
-
-# Copy Lambda function code
-cp $LAMBDA_DIR/*.py $PACKAGE_DIR/
-
-# Install dependencies in the package directory
-echo "   Installing Lambda dependencies..."
-pip install -r $LAMBDA_DIR/requirements.txt -t $PACKAGE_DIR/
-
-# Create deployment package
-echo "   Creating deployment package..."
-cd $PACKAGE_DIR
-zip -r ../lambda-package.zip . -q
-cd ..
-
 # Deploy the stack first (this creates the Lambda function with placeholder code)
 echo "🚀 Deploying the stack..."
 echo "   This may take 5-10 minutes..."
-npx cdk deploy --require-approval never
-
-# Get the Lambda function name from stack outputs
-echo "📋 Getting Lambda function name..."
-LAMBDA_FUNCTION_NAME=$(aws cloudformation describe-stacks \
-    --stack-name DataPipelineStack \
-    --query 'Stacks[0].Outputs[?OutputKey==`LambdaFunctionName`].OutputValue' \
-    --output text)
-
-if [ -z "$LAMBDA_FUNCTION_NAME" ]; then
-    echo "❌ Could not find Lambda function name in stack outputs"
-    exit 1
-fi
-
-echo "   Lambda function name: $LAMBDA_FUNCTION_NAME"
-
-# Update Lambda function code with our package
-echo "🔄 Updating Lambda function code..."
-aws lambda update-function-code \
-    --function-name $LAMBDA_FUNCTION_NAME \
-    --zip-file fileb://lambda-package.zip
-
-# Wait for update to complete
-echo "   Waiting for function update to complete..."
-aws lambda wait function-updated \
-    --function-name $LAMBDA_FUNCTION_NAME
-
-echo "✅ Lambda function updated successfully!"
+# Reuse the cdk.out synthesized above instead of synthesizing again
+npx cdk --app cdk.out deploy --require-approval never
 
-# Clean up package files
-echo "🧹 Cleaning up temporary files..."
-rm -rf $PACKAGE_DIR lambda-package.zip
+# Package the Lambda function with its dependencies and update its code.
+# deploy_lambda.py stages packages over the 50 MB inline limit in S3.
+echo "🔄 Packaging and updating Lambda function code..."
+python3 scripts/deploy_lambda.py
 
 # Get stack outputs
 echo "📋 Getting stack outputs..."
@@ -138,8 +91,8 @@ echo "1. Wait a few minutes for all resources to be ready"
 echo "2. Test the Lambda function manually:"
 echo "   aws lambda invoke --function-name <LAMBDA_FUNCTION_NAME> --payload '{\"bucket_name\": \"<DATA_BUCKET_NAME>\"}' response.json"
 echo ""
-echo "3. Run the Glue crawler:"
-echo "   aws glue start-crawler --name <GLUE_CRAWLER_NAME>"
+echo "3. Inspect the Glue table (partitions are projected, no crawler needed):"
+echo "   aws glue get-table --database-name data_pipeline_db --name users"
 echo ""
 echo "4. Query data with Athena using the AWS Console"
 echo ""
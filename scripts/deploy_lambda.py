@@ -4,12 +4,123 @@ Script to deploy only the Lambda function code without redeploying the entire CD
 This is useful for quick iterations when you only change the Lambda function code.
 """
 
+import base64
 import boto3
+import functools
+import hashlib
+import json
+import orjson
 import zipfile
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import WaiterError
 import os
+import shutil
+import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Persistent build directory: dependencies are installed into it once per
+# requirements change and the function code is overlaid on every deploy
+BUILD_DIR = Path(".lambda-build")
+DEPS_CACHE_DIR = BUILD_DIR / "deps"
+DEPS_HASH_FILE = BUILD_DIR / ".deps-hash"
+SIGNATURES_FILE = BUILD_DIR / "signatures.json"
+PIP_CACHE_DIR = Path(".pip-cache")
+
+# pyarrow and orjson ship native extensions, so install wheels built for the
+# Lambda runtime (PYTHON_3_11 on x86_64) rather than for the build host
+LAMBDA_PLATFORM_ARGS = [
+    "--platform", "manylinux2014_x86_64",
+    "--only-binary=:all:",
+    "--python-version", "3.11",
+    "--implementation", "cp"
+]
+
+# Number of files read ahead concurrently while building the zip
+ZIP_READ_WINDOW = 64
+
+# Packages above this size are uploaded to S3 (multipart, concurrent parts)
+# instead of being sent inline through the Lambda API, which caps at 50 MB
+INLINE_ZIP_LIMIT = 10 * 1024 * 1024
+DEPLOY_KEY_PREFIX = "lambda-deployments"
+# Large packages are staged in the CDK bootstrap assets bucket, away from the pipeline data
+CDK_QUALIFIER = os.environ.get("CDK_QUALIFIER", "hnb659fds")
+HASH_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=8)
+
+@functools.lru_cache(maxsize=None)
+def get_client(service):
+    """Create each boto3 client once and reuse it for the rest of the run"""
+    return boto3.client(service)
+
+def install_dependencies(pip_args, deps_hash):
+    """Install dependencies into the cache directory unless the cached set is current"""
+    hash_file = DEPS_HASH_FILE
+    if hash_file.exists() and hash_file.read_text() == deps_hash:
+        print("   ✅ Dependencies unchanged, using cached packages")
+        return True
+    
+    # Start from an empty cache so removed packages don't linger, and drop the
+    # hash until pip succeeds so a failed install is never mistaken for current
+    hash_file.unlink(missing_ok=True)
+    if DEPS_CACHE_DIR.exists():
+        shutil.rmtree(DEPS_CACHE_DIR)
+    DEPS_CACHE_DIR.mkdir(parents=True)
+    
+    result = subprocess.run([
+        sys.executable, "-m", "pip", "install",
+        "--prefer-binary", "--no-compile",
+        "--cache-dir", str(PIP_CACHE_DIR),
+        *LAMBDA_PLATFORM_ARGS,
+        *pip_args,
+        "-t", str(DEPS_CACHE_DIR)
+    ], capture_output=True, text=True)
+    
+    if result.returncode == 0:
+        hash_file.write_text(deps_hash)
+        print("   ✅ Dependencies installed")
+        return True
+    
+    print(f"   ❌ Dependency installation failed: {result.stderr}")
+    return False
+
+def file_sha256(path):
+    """Hex sha256 of a file's contents"""
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def overlay_function_code(lambda_dir, build_dir):
+    """Copy changed Lambda source files into the build directory.
+    
+    signatures.json maps each source file name to the sha256 it had when it
+    was last copied, so unchanged files are left alone (keeping their mtime
+    and therefore a byte-identical zip) and files deleted from the source
+    directory are removed from the build.
+    """
+    old_signatures = json.loads(SIGNATURES_FILE.read_text()) if SIGNATURES_FILE.exists() else {}
+    signatures = {}
+    
+    def copy_if_changed(src, dst):
+        name = os.path.relpath(src, lambda_dir)
+        signatures[name] = file_sha256(Path(src))
+        if os.path.exists(dst) and old_signatures.get(name) == signatures[name]:
+            return dst
+        print(f"   Added: {name}")
+        return shutil.copy2(src, dst)
+    
+    shutil.copytree(
+        lambda_dir, build_dir,
+        dirs_exist_ok=True,
+        ignore=shutil.ignore_patterns('requirements.txt', '__pycache__', '*.pyc'),
+        copy_function=copy_if_changed
+    )
+    
+    for name in old_signatures.keys() - signatures.keys():
+        (build_dir / name).unlink(missing_ok=True)
+        print(f"   Removed: {name}")
+    
+    SIGNATURES_FILE.write_text(json.dumps(signatures, indent=2, sort_keys=True))
+
 def create_lambda_package():
     """Create a ZIP package of the Lambda function code with dependencies"""
     print("📦 Creating Lambda deployment package...")
@@ -17,65 +128,52 @@ def create_lambda_package():
     # Define paths
     lambda_dir = Path("lambda_functions")
     zip_path = Path("lambda_deployment.zip")
-    temp_dir = Path("temp_lambda_package")
     
     if not lambda_dir.exists():
         print(f"❌ Lambda functions directory not found: {lambda_dir}")
         return None
     
     try:
-        # Create temporary directory for package building
-        temp_dir.mkdir(exist_ok=True)
-        
-        # Copy Lambda function files
-        for py_file in lambda_dir.glob("*.py"):
-            import shutil
-            shutil.copy2(py_file, temp_dir / py_file.name)
-            print(f"   Added: {py_file.name}")
-        
         # Install dependencies if requirements.txt exists
         requirements_file = lambda_dir / "requirements.txt"
         if requirements_file.exists():
             print("   Installing Python dependencies...")
-            import subprocess
-            result = subprocess.run([
-                sys.executable, "-m", "pip", "install", 
-                "-r", str(requirements_file),
-                "-t", str(temp_dir)
-                # Removed --no-deps to include sub-dependencies
-            ], capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                print("   ✅ Dependencies installed")
-            else:
-                print(f"   ⚠️  Dependency installation had issues: {result.stderr}")
+            pip_args = ["-r", str(requirements_file)]
+            requirements = requirements_file.read_bytes()
         else:
             # Install requests manually since we know it's needed
             print("   Installing requests library...")
-            import subprocess
-            result = subprocess.run([
-                sys.executable, "-m", "pip", "install", 
-                "requests",
-                "-t", str(temp_dir)
-                # Removed --no-deps to include sub-dependencies
-            ], capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                print("   ✅ Requests library installed")
-            else:
-                print(f"   ⚠️  Could not install requests: {result.stderr}")
+            pip_args = ["requests"]
+            requirements = b"requests"
         
-        # Create ZIP file from temp directory
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in temp_dir.rglob("*"):
-                if file_path.is_file():
-                    # Use relative path from temp_dir as the archive name
-                    archive_name = file_path.relative_to(temp_dir)
-                    zipf.write(file_path, archive_name)
+        # Key the cache on the target platform too, so changing it reinstalls
+        deps_hash = hashlib.sha256(requirements + " ".join(LAMBDA_PLATFORM_ARGS).encode()).hexdigest()
+        
+        # A failed install has already wiped the cache, so don't ship a package
+        # with missing dependencies
+        if not install_dependencies(pip_args, deps_hash):
+            print("❌ Failed to install Lambda dependencies")
+            return None
+        DEPS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
         
-        # Clean up temp directory
-        import shutil
-        shutil.rmtree(temp_dir)
+        # Overlay the function code on top of the cached dependencies
+        overlay_function_code(lambda_dir, DEPS_CACHE_DIR)
+        
+        # Create ZIP file straight from the build directory; level 1 deflate is
+        # several times faster than the default level 6 for only a slightly
+        # larger archive. Files are sorted so an unchanged build produces a
+        # byte-identical zip whose hash matches the deployed CodeSha256.
+        files = sorted(file_path for file_path in DEPS_CACHE_DIR.rglob("*") if file_path.is_file())
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zipf, \
+                ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # Read files concurrently a window at a time, overlapping disk reads
+            # with compression while keeping memory bounded
+            for start in range(0, len(files), ZIP_READ_WINDOW):
+                window = files[start:start + ZIP_READ_WINDOW]
+                for file_path, data in zip(window, executor.map(Path.read_bytes, window)):
+                    # Use relative path from the build directory as the archive name
+                    zinfo = zipfile.ZipInfo.from_file(file_path, file_path.relative_to(DEPS_CACHE_DIR))
+                    zipf.writestr(zinfo, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
         
         # Check if file was created and has content
         if zip_path.exists() and zip_path.stat().st_size > 0:
@@ -87,50 +185,106 @@ def create_lambda_package():
             
     except Exception as e:
         print(f"❌ Error creating Lambda package: {str(e)}")
-        # Clean up temp directory if it exists
-        if temp_dir.exists():
-            import shutil
-            shutil.rmtree(temp_dir)
         return None
 
-def get_lambda_function_name():
-    """Get the Lambda function name from CloudFormation stack outputs"""
-    print("🔍 Getting Lambda function name from CloudFormation...")
+def get_stack_outputs():
+    """Get all outputs of the CloudFormation stack as an OutputKey -> OutputValue dict"""
+    print("🔍 Getting stack outputs from CloudFormation...")
     
     try:
-        cf_client = boto3.client('cloudformation')
+        cf_client = get_client('cloudformation')
         response = cf_client.describe_stacks(StackName='DataPipelineStack')
-        outputs = response['Stacks'][0]['Outputs']
+        outputs = {
+            output['OutputKey']: output['OutputValue']
+            for output in response['Stacks'][0].get('Outputs', [])
+        }
         
-        for output in outputs:
-            if output['OutputKey'] == 'LambdaFunctionName':
-                function_name = output['OutputValue']
-                print(f"✅ Found Lambda function: {function_name}")
-                return function_name
+        for key in ('LambdaFunctionName', 'DataBucketName'):
+            if key not in outputs:
+                print(f"❌ {key} not found in stack outputs")
+                return None
         
-        print("❌ Lambda function name not found in stack outputs")
-        return None
+        print(f"✅ Found Lambda function: {outputs['LambdaFunctionName']}")
+        return outputs
         
     except Exception as e:
-        print(f"❌ Error getting Lambda function name: {str(e)}")
+        print(f"❌ Error getting stack outputs: {str(e)}")
         return None
 
+def code_unchanged(function_name, zip_path):
+    """Check whether the deployed code already matches the package"""
+    try:
+        lambda_client = get_client('lambda')
+        response = lambda_client.get_function(FunctionName=function_name)
+        deployed_sha = response['Configuration']['CodeSha256']
+    except Exception as e:
+        print(f"⚠️  Could not read deployed code hash: {str(e)}")
+        return False
+    
+    # Lambda reports CodeSha256 as the base64-encoded sha256 digest of the zip;
+    # hash it in chunks rather than loading the whole package into memory
+    digest = hashlib.sha256()
+    with open(zip_path, 'rb') as zip_file:
+        for chunk in iter(lambda: zip_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    package_sha = base64.b64encode(digest.digest()).decode()
+    if package_sha == deployed_sha:
+        return True
+    
+    print(f"   Package hash {package_sha} differs from deployed {deployed_sha}")
+    return False
+
+def get_assets_bucket():
+    """Name of the CDK bootstrap assets bucket for the current account and region"""
+    account = get_client('sts').get_caller_identity()['Account']
+    region = get_client('s3').meta.region_name
+    return f"cdk-{CDK_QUALIFIER}-assets-{account}-{region}"
+
+def delete_staged_package(bucket, key, version_id):
+    """Remove a staged package; failures only warn since the function is already updated"""
+    try:
+        # The assets bucket is versioned, so delete the exact version rather
+        # than leaving a noncurrent copy behind a delete marker
+        delete_args = {'VersionId': version_id} if version_id else {}
+        get_client('s3').delete_object(Bucket=bucket, Key=key, **delete_args)
+    except Exception as e:
+        print(f"⚠️  Could not delete staged package s3://{bucket}/{key}: {str(e)}")
+
 def update_lambda_code(function_name, zip_path):
     """Update the Lambda function code"""
     print(f"🚀 Updating Lambda function code: {function_name}")
     
     try:
-        lambda_client = boto3.client('lambda')
-        
-        # Read the ZIP file
-        with open(zip_path, 'rb') as zip_file:
-            zip_content = zip_file.read()
+        lambda_client = get_client('lambda')
         
-        # Update the function code
-        response = lambda_client.update_function_code(
-            FunctionName=function_name,
-            ZipFile=zip_content
-        )
+        if zip_path.stat().st_size > INLINE_ZIP_LIMIT:
+            # Stage large packages in S3 and let Lambda pull them from there
+            s3_client = get_client('s3')
+            deploy_bucket = get_assets_bucket()
+            deploy_key = f"{DEPLOY_KEY_PREFIX}/{function_name}.zip"
+            print(f"   Uploading package to s3://{deploy_bucket}/{deploy_key}")
+            s3_client.upload_file(str(zip_path), deploy_bucket, deploy_key, Config=UPLOAD_CONFIG)
+            version_id = s3_client.head_object(Bucket=deploy_bucket, Key=deploy_key).get('VersionId')
+            
+            try:
+                response = lambda_client.update_function_code(
+                    FunctionName=function_name,
+                    S3Bucket=deploy_bucket,
+                    S3Key=deploy_key
+                )
+            finally:
+                # Lambda copies the package during the call, so the staged object can go
+                delete_staged_package(deploy_bucket, deploy_key, version_id)
+        else:
+            # Read the ZIP file
+            with open(zip_path, 'rb') as zip_file:
+                zip_content = zip_file.read()
+            
+            # Update the function code
+            response = lambda_client.update_function_code(
+                FunctionName=function_name,
+                ZipFile=zip_content
+            )
         
         print("✅ Lambda function updated successfully")
         print(f"   Function ARN: {response['FunctionArn']}")
@@ -143,66 +297,44 @@ def update_lambda_code(function_name, zip_path):
         print(f"❌ Error updating Lambda function: {str(e)}")
         return False
 
-def wait_for_function_ready(function_name, max_attempts=30):
+def wait_for_function_ready(function_name, max_attempts=60):
     """Wait for the Lambda function to be ready after update"""
     print("⏳ Waiting for Lambda function to be ready...")
     
-    lambda_client = boto3.client('lambda')
-    
-    for attempt in range(max_attempts):
-        try:
-            response = lambda_client.get_function(FunctionName=function_name)
-            state = response['Configuration']['State']
-            
-            if state == 'Active':
-                print("✅ Lambda function is ready")
-                return True
-            elif state == 'Pending':
-                print(f"   Status: {state} (attempt {attempt + 1}/{max_attempts})")
-                import time
-                time.sleep(2)
-            else:
-                print(f"❌ Unexpected Lambda state: {state}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error checking Lambda status: {str(e)}")
-            return False
+    lambda_client = get_client('lambda')
     
-    print("❌ Timeout waiting for Lambda function to be ready")
-    return False
+    try:
+        # The waiter returns as soon as the code update has been applied
+        waiter = lambda_client.get_waiter('function_updated_v2')
+        waiter.wait(
+            FunctionName=function_name,
+            WaiterConfig={'Delay': 1, 'MaxAttempts': max_attempts}
+        )
+        print("✅ Lambda function is ready")
+        return True
+        
+    except WaiterError as e:
+        print(f"❌ Lambda function did not become ready: {str(e)}")
+        return False
+    except Exception as e:
+        print(f"❌ Error checking Lambda status: {str(e)}")
+        return False
 
-def test_updated_function(function_name):
+def test_updated_function(function_name, data_bucket_name):
     """Test the updated Lambda function"""
     print("🧪 Testing updated Lambda function...")
     
     try:
-        lambda_client = boto3.client('lambda')
-        
-        # Get data bucket name for test
-        cf_client = boto3.client('cloudformation')
-        response = cf_client.describe_stacks(StackName='DataPipelineStack')
-        outputs = response['Stacks'][0]['Outputs']
-        
-        data_bucket_name = None
-        for output in outputs:
-            if output['OutputKey'] == 'DataBucketName':
-                data_bucket_name = output['OutputValue']
-                break
-        
-        if not data_bucket_name:
-            print("❌ Could not find data bucket name for testing")
-            return False
+        lambda_client = get_client('lambda')
         
         # Invoke the function
-        import json
         response = lambda_client.invoke(
             FunctionName=function_name,
-            Payload=json.dumps({"bucket_name": data_bucket_name})
+            Payload=orjson.dumps({"bucket_name": data_bucket_name})
         )
         
         if response['StatusCode'] == 200:
-            payload = json.loads(response['Payload'].read())
+            payload = orjson.loads(response['Payload'].read())
             print("✅ Lambda function test successful")
             print(f"   Response: {payload}")
             return True
@@ -240,21 +372,25 @@ def main():
         if not zip_path:
             return 1
         
-        # Step 2: Get Lambda function name
-        function_name = get_lambda_function_name()
-        if not function_name:
-            return 1
-        
-        # Step 3: Update Lambda code
-        if not update_lambda_code(function_name, zip_path):
+        # Step 2: Get stack outputs (Lambda function and data bucket names)
+        outputs = get_stack_outputs()
+        if not outputs:
             return 1
+        function_name = outputs['LambdaFunctionName']
         
-        # Step 4: Wait for function to be ready
-        if not wait_for_function_ready(function_name):
-            return 1
+        # Steps 3-4: Update Lambda code and wait for it to be ready, unless
+        # the deployed code is already identical
+        if code_unchanged(function_name, zip_path):
+            print("✅ Deployed code is unchanged, skipping upload and wait")
+        else:
+            if not update_lambda_code(function_name, zip_path):
+                return 1
+            
+            if not wait_for_function_ready(function_name):
+                return 1
         
         # Step 5: Test the updated function
-        if not test_updated_function(function_name):
+        if not test_updated_function(function_name, outputs['DataBucketName']):
             print("⚠️  Lambda update completed but test failed")
             return 1
         
@@ -1,14 +1,14 @@
 -- Sample Athena Queries for Data Pipeline
--- Execute these queries after the Glue crawler has cataloged your data
+-- The users table is defined by the CDK stack and uses partition projection on ingest_date
 
 -- 1. Basic data exploration
 -- Count total number of users
 SELECT COUNT(*) as total_users 
-FROM data_pipeline_db.raw_data;
+FROM data_pipeline_db.users;
 
 -- View first 10 records
 SELECT * 
-FROM data_pipeline_db.raw_data 
+FROM data_pipeline_db.users 
 LIMIT 10;
 
 -- Check data freshness
@@ -16,14 +16,14 @@ SELECT
     MIN(extraction_timestamp) as earliest_data,
     MAX(extraction_timestamp) as latest_data,
     COUNT(*) as total_records
-FROM data_pipeline_db.raw_data;
+FROM data_pipeline_db.users;
 
 -- 2. Geographic analysis
 -- Users by city
 SELECT 
     address_city,
     COUNT(*) as user_count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE address_city IS NOT NULL
 GROUP BY address_city
 ORDER BY user_count DESC;
@@ -34,7 +34,7 @@ SELECT
     address_lng,
     address_city,
     COUNT(*) as users_at_location
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE address_lat IS NOT NULL AND address_lng IS NOT NULL
 GROUP BY address_lat, address_lng, address_city
 ORDER BY users_at_location DESC;
@@ -44,7 +44,7 @@ ORDER BY users_at_location DESC;
 SELECT 
     SUBSTR(email, STRPOS(email, '@') + 1) as domain,
     COUNT(*) as count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE email IS NOT NULL
 GROUP BY SUBSTR(email, STRPOS(email, '@') + 1)
 ORDER BY count DESC;
@@ -55,7 +55,7 @@ SELECT
     website,
     company_name,
     email
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE website IS NOT NULL AND website != ''
 ORDER BY name;
 
@@ -68,7 +68,7 @@ SELECT
         ELSE 'Other Format'
     END as phone_format,
     COUNT(*) as count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE phone IS NOT NULL
 GROUP BY 
     CASE 
@@ -84,7 +84,7 @@ ORDER BY count DESC;
 SELECT 
     company_name,
     COUNT(*) as employee_count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE company_name IS NOT NULL
 GROUP BY company_name
 ORDER BY employee_count DESC;
@@ -94,7 +94,7 @@ SELECT
     company_catchphrase,
     company_name,
     COUNT(*) as usage_count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE company_catchphrase IS NOT NULL
 GROUP BY company_catchphrase, company_name
 ORDER BY usage_count DESC;
@@ -103,7 +103,7 @@ ORDER BY usage_count DESC;
 SELECT 
     company_bs,
     COUNT(*) as count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE company_bs IS NOT NULL
 GROUP BY company_bs
 ORDER BY count DESC;
@@ -113,7 +113,7 @@ ORDER BY count DESC;
 SELECT 
     email,
     COUNT(*) as count
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE email IS NOT NULL
 GROUP BY email
 HAVING COUNT(*) > 1;
@@ -125,7 +125,7 @@ SELECT
     SUM(CASE WHEN phone IS NULL OR phone = '' THEN 1 ELSE 0 END) as missing_phones,
     SUM(CASE WHEN address_city IS NULL OR address_city = '' THEN 1 ELSE 0 END) as missing_cities,
     COUNT(*) as total_records
-FROM data_pipeline_db.raw_data;
+FROM data_pipeline_db.users;
 
 -- Data completeness by field
 SELECT 
@@ -136,7 +136,7 @@ SELECT
         100.0 * SUM(CASE WHEN name IS NOT NULL AND name != '' THEN 1 ELSE 0 END) / COUNT(*), 
         2
     ) as completeness_percentage
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 
 UNION ALL
 
@@ -148,7 +148,7 @@ SELECT
         100.0 * SUM(CASE WHEN email IS NOT NULL AND email != '' THEN 1 ELSE 0 END) / COUNT(*), 
         2
     ) as completeness_percentage
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 
 UNION ALL
 
@@ -160,14 +160,14 @@ SELECT
         100.0 * SUM(CASE WHEN phone IS NOT NULL AND phone != '' THEN 1 ELSE 0 END) / COUNT(*), 
         2
     ) as completeness_percentage
-FROM data_pipeline_db.raw_data;
+FROM data_pipeline_db.users;
 
 -- 6. Time-based analysis (if you have historical data)
 -- Data extraction trends (if running multiple times)
 SELECT 
     DATE(extraction_timestamp) as extraction_date,
     COUNT(*) as records_extracted
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 GROUP BY DATE(extraction_timestamp)
 ORDER BY extraction_date DESC;
 
@@ -182,7 +182,7 @@ SELECT
     company_name,
     phone,
     website
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE email IS NOT NULL
 ORDER BY name;
 
@@ -192,17 +192,15 @@ SELECT
     company_name,
     COUNT(*) as user_count,
     STRING_AGG(name, ', ') as users
-FROM data_pipeline_db.raw_data
+FROM data_pipeline_db.users
 WHERE address_city IS NOT NULL AND company_name IS NOT NULL
 GROUP BY address_city, company_name
 HAVING COUNT(*) >= 1
 ORDER BY address_city, user_count DESC;
 
--- Performance optimization example: Use partition projection for time-based queries
--- (This would require partitioning your data by date in S3)
-/*
+-- Performance optimization example: filter on the projected ingest_date partition
+-- so Athena only reads that day's Parquet file
 SELECT *
-FROM data_pipeline_db.raw_data
-WHERE year = '2025' AND month = '09' AND day = '14'
+FROM data_pipeline_db.users
+WHERE ingest_date = '2025-09-14'
 LIMIT 100;
-*/
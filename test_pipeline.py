@@ -4,16 +4,58 @@ Test script for the AWS CDK Data Pipeline
 This script helps test the deployed infrastructure step by step
 """
 
+import argparse
 import boto3
+import functools
 import json
+import orjson
 import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from botocore.exceptions import ClientError, WaiterError
+from botocore.waiter import WaiterModel, create_waiter_with_client
+
+# Custom waiter that polls a batch of Athena queries with a single API call
+# until none of them is still queued or running
+ATHENA_QUERY_WAITER_MODEL = WaiterModel({
+    'version': 2,
+    'waiters': {
+        'QueriesCompleted': {
+            'operation': 'BatchGetQueryExecution',
+            'delay': 1,
+            'maxAttempts': 60,
+            'acceptors': [
+                {
+                    'matcher': 'path',
+                    'argument': "length(QueryExecutions[?Status.State=='QUEUED' || Status.State=='RUNNING'])",
+                    'expected': 0,
+                    'state': 'success'
+                }
+            ]
+        }
+    }
+})
+
+# Resolved stack outputs are cached on disk so reruns skip describe_stacks
+CFN_OUTPUTS_CACHE = Path(__file__).with_name('.cfn-outputs.json')
+CFN_OUTPUTS_TTL = 300  # seconds
+REQUIRED_CONFIG_KEYS = ['lambda_function_name', 'data_bucket_name', 'athena_results_bucket_name']
+
+@functools.lru_cache(maxsize=None)
+def get_client(service):
+    """Create each boto3 client once and reuse it for the rest of the run"""
+    return boto3.client(service)
 
 class DataPipelineTester:
     def __init__(self):
-        self.lambda_client = boto3.client('lambda')
-        self.s3_client = boto3.client('s3')
-        self.glue_client = boto3.client('glue')
-        self.athena_client = boto3.client('athena')
+        self.lambda_client = get_client('lambda')
+        self.s3_client = get_client('s3')
+        self.glue_client = get_client('glue')
+        self.athena_client = get_client('athena')
+        self.query_waiter = create_waiter_with_client(
+            'QueriesCompleted', ATHENA_QUERY_WAITER_MODEL, self.athena_client
+        )
         
     def test_lambda_function(self, function_name, bucket_name):
         """Test the Lambda function"""
@@ -21,33 +63,59 @@ class DataPipelineTester:
         try:
             response = self.lambda_client.invoke(
                 FunctionName=function_name,
-                Payload=json.dumps({"bucket_name": bucket_name})
+                Payload=orjson.dumps({"bucket_name": bucket_name})
             )
             
-            payload = json.loads(response['Payload'].read())
+            payload = orjson.loads(response['Payload'].read())
             if response['StatusCode'] == 200:
                 print("✅ Lambda function executed successfully")
                 print(f"   Response: {payload}")
-                return True
+                # Location of the file written by this invocation
+                body = orjson.loads(payload['body']) if isinstance(payload, dict) and 'body' in payload else {}
+                return True, body.get('s3_location')
             else:
                 print(f"❌ Lambda function failed: {payload}")
-                return False
+                return False, None
         except Exception as e:
             print(f"❌ Error testing Lambda: {str(e)}")
+            return False, None
+
+    def wait_for_s3_data(self, s3_location, max_wait=30):
+        """Poll S3 with exponential backoff until the object written by this run shows up"""
+        bucket_name, _, key = s3_location.removeprefix('s3://').partition('/')
+        delay = 0.5
+        deadline = time.monotonic() + max_wait
+        try:
+            while True:
+                try:
+                    self.s3_client.head_object(Bucket=bucket_name, Key=key)
+                    return True
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                        raise
+                if time.monotonic() + delay > deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+        except Exception as e:
+            print(f"❌ Error waiting for {s3_location}: {str(e)}")
             return False
 
     def check_s3_data(self, bucket_name):
         """Check if data exists in S3"""
         print(f"🔍 Checking S3 bucket: {bucket_name}")
         try:
+            # Only the first 5 objects are shown, so don't fetch more than that
             response = self.s3_client.list_objects_v2(
                 Bucket=bucket_name,
-                Prefix='raw-data/'
+                Prefix='raw-data/',
+                MaxKeys=5
             )
             
             if 'Contents' in response and len(response['Contents']) > 0:
-                print(f"✅ Found {len(response['Contents'])} objects in S3")
-                for obj in response['Contents'][:5]:  # Show first 5 objects
+                more = "+" if response.get('IsTruncated') else ""
+                print(f"✅ Found {len(response['Contents'])}{more} objects in S3")
+                for obj in response['Contents']:
                     print(f"   - {obj['Key']} ({obj['Size']} bytes)")
                 return True
             else:
@@ -57,31 +125,6 @@ class DataPipelineTester:
             print(f"❌ Error checking S3: {str(e)}")
             return False
 
-    def test_glue_crawler(self, crawler_name):
-        """Start and monitor Glue crawler"""
-        print(f"🔍 Testing Glue crawler: {crawler_name}")
-        try:
-            # Check crawler status
-            response = self.glue_client.get_crawler(Name=crawler_name)
-            state = response['Crawler']['State']
-            print(f"   Crawler state: {state}")
-            
-            if state == 'READY':
-                print("   Starting crawler...")
-                self.glue_client.start_crawler(Name=crawler_name)
-                print("✅ Crawler started successfully")
-                print("   Note: Crawler may take a few minutes to complete")
-                return True
-            elif state == 'RUNNING':
-                print("✅ Crawler is already running")
-                return True
-            else:
-                print(f"❌ Crawler is in unexpected state: {state}")
-                return False
-        except Exception as e:
-            print(f"❌ Error testing Glue crawler: {str(e)}")
-            return False
-
     def check_glue_tables(self, database_name):
         """Check Glue catalog tables"""
         print(f"🔍 Checking Glue tables in database: {database_name}")
@@ -96,7 +139,7 @@ class DataPipelineTester:
                 return True
             else:
                 print("❌ No tables found in Glue catalog")
-                print("   Make sure the crawler has completed successfully")
+                print("   Make sure the DataPipelineStack is deployed")
                 return False
         except Exception as e:
             print(f"❌ Error checking Glue tables: {str(e)}")
@@ -106,7 +149,6 @@ class DataPipelineTester:
         """Test multiple Athena queries with named results"""
         print("🔍 Testing Athena queries")
         
-        from datetime import datetime
         timestamp = datetime.now().strftime("%H:%M")
         
         # Define queries to test
@@ -115,28 +157,30 @@ class DataPipelineTester:
                 'name': f'count_rows_{timestamp}',
                 'description': 'Total record count',
                 'sql': f"SELECT COUNT(*) as record_count FROM {database_name}.{table_name}",
-                'result_column': 'record_count'
+                'result_column': 'record_count',
+                'max_results': 2  # header + count
             },
             {
                 'name': f'users_{timestamp}',
                 'description': 'User data',
                 'sql': f"SELECT name, email, address_city FROM {database_name}.{table_name} LIMIT 5",
-                'result_column': 'name'
+                'result_column': 'name',
+                'max_results': 6  # header + LIMIT 5
             },
             {
                 'name': f'users_by_city_{timestamp}',
                 'description': 'Users by city',
                 'sql': f"SELECT address_city, COUNT(*) as user_count FROM {database_name}.{table_name} GROUP BY address_city ORDER BY user_count DESC LIMIT 3",
-                'result_column': 'address_city'
+                'result_column': 'address_city',
+                'max_results': 4  # header + LIMIT 3
             }
         ]
         
         all_queries_passed = True
         query_executions = []  # Track execution IDs and query info
         
-        for i, query_info in enumerate(queries, 1):
-            print(f"\n   Query {i}: {query_info['description']} ({query_info['name']})")
-            
+        # Submit every query up front so they run concurrently
+        for query_info in queries:
             try:
                 # Use custom result location with query name
                 custom_result_location = f's3://{results_bucket}/query-results/{query_info["name"]}/'
@@ -149,77 +193,108 @@ class DataPipelineTester:
                     }
                 )
                 
-                query_execution_id = response['QueryExecutionId']
-                print(f"   ├─ Execution ID: {query_execution_id}")
-                
                 # Store the mapping for later reference
                 query_executions.append({
-                    'execution_id': query_execution_id,
+                    'execution_id': response['QueryExecutionId'],
                     'query_info': query_info
                 })
-                
-                # Wait for query to complete
-                max_attempts = 30
-                for attempt in range(max_attempts):
-                    result = self.athena_client.get_query_execution(
-                        QueryExecutionId=query_execution_id
-                    )
-                    status = result['QueryExecution']['Status']['State']
-                    
-                    if status == 'SUCCEEDED':
-                        print("   ├─ Status: ✅ SUCCESS")
-                        
-                        # Get query results
-                        results = self.athena_client.get_query_results(
-                            QueryExecutionId=query_execution_id
-                        )
-                        
-                        if 'ResultSet' in results and 'Rows' in results['ResultSet']:
-                            rows = results['ResultSet']['Rows']
-                            if len(rows) > 1:  # Skip header row
-                                if query_info['name'].startswith('count_rows'):
-                                    count = rows[1]['Data'][0]['VarCharValue']
-                                    print(f"   └─ Result: {count} total records")
-                                elif query_info['name'].startswith('users_by_city'):
-                                    city_count = len(rows) - 1  # Exclude header
-                                    print(f"   └─ Result: Found {city_count} unique cities")
-                                    for j, row in enumerate(rows[1:], 1):
-                                        if len(row['Data']) >= 2:
-                                            city = row['Data'][0].get('VarCharValue', 'N/A')
-                                            count = row['Data'][1].get('VarCharValue', 'N/A')
-                                            print(f"      {j}. {city}: {count} users")
-                                elif query_info['name'].startswith('users'):
-                                    sample_count = len(rows) - 1  # Exclude header
-                                    print(f"   └─ Result: Retrieved {sample_count} sample users")
-                                    for j, row in enumerate(rows[1:4], 1):  # Show first 3
-                                        if len(row['Data']) >= 3:
-                                            name = row['Data'][0].get('VarCharValue', 'N/A')
-                                            city = row['Data'][2].get('VarCharValue', 'N/A')
-                                            print(f"      {j}. {name} from {city}")
-                                else:
-                                    # Generic fallback for any other query types
-                                    result_count = len(rows) - 1
-                                    print(f"   └─ Result: Retrieved {result_count} rows")
-                        break
-                    elif status == 'FAILED':
-                        error = result['QueryExecution']['Status'].get('StateChangeReason', 'Unknown error')
-                        print(f"   └─ Status: ❌ FAILED - {error}")
-                        all_queries_passed = False
-                        break
-                    elif status == 'CANCELLED':
-                        print("   └─ Status: ❌ CANCELLED")
-                        all_queries_passed = False
-                        break
-                    else:
-                        time.sleep(2)
-                else:
-                    print("   └─ Status: ❌ TIMEOUT")
-                    all_queries_passed = False
-                    
             except Exception as e:
+                print(f"\n   {query_info['description']} ({query_info['name']})")
                 print(f"   └─ Status: ❌ ERROR - {str(e)}")
                 all_queries_passed = False
         
+        if not query_executions:
+            print("\n❌ Some Athena queries failed")
+            return False, query_executions
+        
+        execution_ids = [exec_info['execution_id'] for exec_info in query_executions]
+        
+        try:
+            # Wait for all queries to finish, polling them in one call per attempt
+            try:
+                self.query_waiter.wait(QueryExecutionIds=execution_ids)
+            except WaiterError:
+                # Out of attempts; queries still running are reported as timed out
+                pass
+            
+            response = self.athena_client.batch_get_query_execution(QueryExecutionIds=execution_ids)
+            executions = {
+                execution['QueryExecutionId']: execution
+                for execution in response['QueryExecutions']
+            }
+            
+            # Fetch the results of the successful queries concurrently, asking
+            # only for as many rows as each query can return
+            succeeded = [
+                exec_info for exec_info in query_executions
+                if executions.get(exec_info['execution_id'], {}).get('Status', {}).get('State') == 'SUCCEEDED'
+            ]
+            with ThreadPoolExecutor(max_workers=max(len(succeeded), 1)) as executor:
+                query_results = dict(zip(
+                    (exec_info['execution_id'] for exec_info in succeeded),
+                    executor.map(
+                        lambda exec_info: self.athena_client.get_query_results(
+                            QueryExecutionId=exec_info['execution_id'],
+                            MaxResults=exec_info['query_info']['max_results']
+                        ),
+                        succeeded
+                    )
+                ))
+        except Exception as e:
+            print(f"   └─ Status: ❌ ERROR - {str(e)}")
+            return False, query_executions
+        
+        for i, exec_info in enumerate(query_executions, 1):
+            query_execution_id = exec_info['execution_id']
+            query_info = exec_info['query_info']
+            print(f"\n   Query {i}: {query_info['description']} ({query_info['name']})")
+            print(f"   ├─ Execution ID: {query_execution_id}")
+            
+            result = executions.get(query_execution_id, {})
+            status = result.get('Status', {}).get('State')
+            
+            if status == 'SUCCEEDED':
+                print("   ├─ Status: ✅ SUCCESS")
+                
+                results = query_results[query_execution_id]
+                
+                if 'ResultSet' in results and 'Rows' in results['ResultSet']:
+                    rows = results['ResultSet']['Rows']
+                    if len(rows) > 1:  # Skip header row
+                        if query_info['name'].startswith('count_rows'):
+                            count = rows[1]['Data'][0]['VarCharValue']
+                            print(f"   └─ Result: {count} total records")
+                        elif query_info['name'].startswith('users_by_city'):
+                            city_count = len(rows) - 1  # Exclude header
+                            print(f"   └─ Result: Found {city_count} unique cities")
+                            for j, row in enumerate(rows[1:], 1):
+                                if len(row['Data']) >= 2:
+                                    city = row['Data'][0].get('VarCharValue', 'N/A')
+                                    count = row['Data'][1].get('VarCharValue', 'N/A')
+                                    print(f"      {j}. {city}: {count} users")
+                        elif query_info['name'].startswith('users'):
+                            sample_count = len(rows) - 1  # Exclude header
+                            print(f"   └─ Result: Retrieved {sample_count} sample users")
+                            for j, row in enumerate(rows[1:4], 1):  # Show first 3
+                                if len(row['Data']) >= 3:
+                                    name = row['Data'][0].get('VarCharValue', 'N/A')
+                                    city = row['Data'][2].get('VarCharValue', 'N/A')
+                                    print(f"      {j}. {name} from {city}")
+                        else:
+                            # Generic fallback for any other query types
+                            result_count = len(rows) - 1
+                            print(f"   └─ Result: Retrieved {result_count} rows")
+            elif status == 'FAILED':
+                error = result['Status'].get('StateChangeReason', 'Unknown error')
+                print(f"   └─ Status: ❌ FAILED - {error}")
+                all_queries_passed = False
+            elif status == 'CANCELLED':
+                print("   └─ Status: ❌ CANCELLED")
+                all_queries_passed = False
+            else:
+                print("   └─ Status: ❌ TIMEOUT")
+                all_queries_passed = False
+        
         if all_queries_passed:
             print("\n✅ All Athena queries completed successfully")
             
@@ -245,66 +320,69 @@ class DataPipelineTester:
             exec_id_map = {exec_info['execution_id']: exec_info['query_info'] for exec_info in query_executions}
             
             try:
-                response = self.s3_client.list_objects_v2(
-                    Bucket=results_bucket,
-                    Prefix='query-results/'
-                )
+                # Group files by query type using execution ID
+                query_files = {}
                 
-                if 'Contents' in response:
-                    # Group files by query type using execution ID
-                    query_files = {}
+                # The workgroup enforces query-results/ as the output location, so each
+                # execution's results are query-results/<execution-id>.csv(.metadata);
+                # look those keys up directly instead of listing the folder
+                for exec_id, query_info in exec_id_map.items():
+                    csv_key = f'query-results/{exec_id}.csv'
+                    try:
+                        head = self.s3_client.head_object(Bucket=results_bucket, Key=csv_key)
+                    except ClientError as e:
+                        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                            continue
+                        raise
                     
-                    for obj in response['Contents']:
-                        key = obj['Key']
-                        if key.endswith('.csv') and not key.endswith('/'):
-                            # Extract execution ID from filename: query-results/execution-id.csv
-                            filename = key.split('/')[-1]  # Get just the filename
-                            exec_id = filename.replace('.csv', '')  # Remove .csv extension
-                            
-                            if exec_id in exec_id_map:
-                                query_info = exec_id_map[exec_id]
-                                query_type = query_info['description']
-                                
-                                if query_type not in query_files:
-                                    query_files[query_type] = []
-                                
-                                query_files[query_type].append({
-                                    'csv_file': key,
-                                    'metadata_file': key + '.metadata',
-                                    'size': obj['Size'],
-                                    'exec_id': exec_id
-                                })
+                    query_type = query_info['description']
                     
-                    # Display organized results
-                    if query_files:
-                        for query_type, files in query_files.items():
-                            print(f"\n   📊 {query_type}:")
-                            for file_info in files:
-                                print(f"      ├─ CSV: {file_info['csv_file']} ({file_info['size']} bytes)")
-                                print(f"      │  └─ s3://{results_bucket}/{file_info['csv_file']}")
-                                print(f"      └─ Metadata: {file_info['metadata_file']}")
-                                print(f"         └─ s3://{results_bucket}/{file_info['metadata_file']}")
-                    else:
-                        print("   No matching query result files found for recent executions")
+                    if query_type not in query_files:
+                        query_files[query_type] = []
+                    
+                    query_files[query_type].append({
+                        'csv_file': csv_key,
+                        'metadata_file': csv_key + '.metadata',
+                        'size': head['ContentLength'],
+                        'exec_id': exec_id
+                    })
+                
+                # Display organized results
+                if query_files:
+                    for query_type, files in query_files.items():
+                        print(f"\n   📊 {query_type}:")
+                        for file_info in files:
+                            print(f"      ├─ CSV: {file_info['csv_file']} ({file_info['size']} bytes)")
+                            print(f"      │  └─ s3://{results_bucket}/{file_info['csv_file']}")
+                            print(f"      └─ Metadata: {file_info['metadata_file']}")
+                            print(f"         └─ s3://{results_bucket}/{file_info['metadata_file']}")
                 else:
-                    print("   No files found in query-results folder")
+                    print("   No matching query result files found for recent executions")
                     
             except Exception as e:
                 print(f"   ❌ Error listing result files: {str(e)}")
         else:
             print("   No query execution information available")
 
-def get_stack_outputs():
-    """Get the stack outputs dynamically from CloudFormation"""
-    import boto3
+def get_stack_outputs(refresh=False):
+    """Get the stack outputs dynamically from CloudFormation, cached for a few minutes"""
+    if not refresh:
+        try:
+            if CFN_OUTPUTS_CACHE.stat().st_mtime > time.time() - CFN_OUTPUTS_TTL:
+                config = json.loads(CFN_OUTPUTS_CACHE.read_text())
+                if all(key in config for key in REQUIRED_CONFIG_KEYS):
+                    return config
+        except (OSError, json.JSONDecodeError, TypeError):
+            # Missing, unreadable or corrupt cache; fall through to the live lookup
+            pass
+    
     try:
-        cf_client = boto3.client('cloudformation')
+        cf_client = get_client('cloudformation')
         response = cf_client.describe_stacks(StackName='DataPipelineStack')
         outputs = response['Stacks'][0]['Outputs']
         
         config = {
             'glue_database_name': 'data_pipeline_db',
-            'glue_crawler_name': 'data-pipeline-crawler', 
             'athena_workgroup': 'data-pipeline-workgroup'
         }
         
@@ -319,6 +397,10 @@ def get_stack_outputs():
                 config['data_bucket_name'] = value
             elif key == 'AthenaResultsBucketName':
                 config['athena_results_bucket_name'] = value
+        
+        # Only cache a complete config so a partially deployed stack is re-read
+        if all(key in config for key in REQUIRED_CONFIG_KEYS):
+            CFN_OUTPUTS_CACHE.write_text(json.dumps(config, indent=2))
                 
         return config
         
@@ -332,14 +414,21 @@ def main():
     print("🚀 Starting Data Pipeline Tests")
     print("=" * 50)
     
+    parser = argparse.ArgumentParser(description="Test the deployed data pipeline")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help=f"re-read the stack outputs instead of using {CFN_OUTPUTS_CACHE.name} (cached for {CFN_OUTPUTS_TTL}s)"
+    )
+    args = parser.parse_args()
+    
     # Get configuration dynamically from CloudFormation stack outputs
-    config = get_stack_outputs()
+    config = get_stack_outputs(refresh=args.refresh)
     if not config:
         return
     
     # Verify all required values are present
-    required_keys = ['lambda_function_name', 'data_bucket_name', 'athena_results_bucket_name']
-    missing_keys = [key for key in required_keys if key not in config]
+    missing_keys = [key for key in REQUIRED_CONFIG_KEYS if key not in config]
     
     if missing_keys:
         print(f"❌ Missing required configuration: {missing_keys}")
@@ -351,38 +440,30 @@ def main():
     # Test 1: Lambda function
     print("\n1. Testing Lambda Function")
     print("-" * 30)
-    lambda_success = tester.test_lambda_function(
+    lambda_success, s3_location = tester.test_lambda_function(
         config['lambda_function_name'], 
         config['data_bucket_name']
     )
     
-    if lambda_success:
-        # Wait a bit for data to be uploaded
-        print("   Waiting 10 seconds for data upload...")
-        time.sleep(10)
+    if lambda_success and s3_location:
+        # Wait for this run's file to be uploaded
+        print(f"   Waiting for {s3_location}...")
+        if not tester.wait_for_s3_data(s3_location):
+            print("   ⚠️  The extracted file did not show up in S3")
     
     # Test 2: S3 data
     print("\n2. Checking S3 Data")
     print("-" * 30)
     s3_success = tester.check_s3_data(config['data_bucket_name'])
     
-    # Test 3: Glue crawler
-    print("\n3. Testing Glue Crawler")
-    print("-" * 30)
-    crawler_success = tester.test_glue_crawler(config['glue_crawler_name'])
-    
-    if crawler_success:
-        print("   Waiting 60 seconds for crawler to process data...")
-        time.sleep(60)
-    
-    # Test 4: Glue tables
-    print("\n4. Checking Glue Catalog")
+    # Test 3: Glue tables
+    print("\n3. Checking Glue Catalog")
     print("-" * 30)
     tables_success = tester.check_glue_tables(config['glue_database_name'])
     
-    # Test 5: Athena query (only if tables exist)
+    # Test 4: Athena query (only if tables exist)
     if tables_success:
-        print("\n5. Testing Athena Query")
+        print("\n4. Testing Athena Query")
         print("-" * 30)
         
         # Get the table name (assumes first table)
@@ -404,7 +485,7 @@ def main():
             print(f"❌ Error getting table name: {str(e)}")
             athena_success = False
     else:
-        print("\n5. Skipping Athena Test (no tables found)")
+        print("\n4. Skipping Athena Test (no tables found)")
         athena_success = False
     
     # Summary
@@ -415,7 +496,6 @@ def main():
     tests = [
         ("Lambda Function", lambda_success),
         ("S3 Data Storage", s3_success),
-        ("Glue Crawler", crawler_success),
         ("Glue Catalog", tables_success),
         ("Athena Query", athena_success)
     ]